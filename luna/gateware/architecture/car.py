@@ -6,14 +6,198 @@
 
 """ Clock and reset (CAR) controllers for LUNA. """
 
+import re
 import logging
 
-from abc import ABCMeta, abstractmethod
-from amaranth import Signal, Module, ClockDomain, ClockSignal, Elaboratable, Instance, ResetSignal
+from abc       import ABCMeta, abstractmethod
+from functools import lru_cache
+
+from amaranth         import Signal, Module, ClockDomain, ClockSignal, Elaboratable, Instance, ResetSignal, DomainRenamer
+from amaranth.lib.cdc import AsyncFFSynchronizer, PulseSynchronizer, ResetSynchronizer
 
 from ..utils.cdc import stretch_strobe_signal
 
 
+def _compute_pll_phase(divider, phase=0):
+    """ Computes the EHXPLLL CPHASE/FPHASE settings for a given output.
+
+    Parameters:
+        divider -- The output divider (CLKO*_DIV) applied to the PLL's VCO for the given output.
+        phase   -- The desired phase shift of the output, in degrees.
+
+    Returns a (cphase, fphase) tuple. CPHASE counts whole VCO cycles, and FPHASE counts
+    eighths of a VCO cycle; a CPHASE of (divider - 1) corresponds to a phase shift of zero.
+    """
+
+    # One output cycle lasts `divider` VCO cycles; so our phase shift, in VCO cycles, is
+    # (phase * divider) / 360. We compute this as a fixed-point value with four fractional
+    # bits, and then round away the last bit to get the eighth-cycle resolution of FPHASE.
+    phase_shift = int((phase % 360) * divider * 16 / 360)
+    phase_shift = (phase_shift + 1) >> 1
+
+    cphase = (divider - 1) + (phase_shift >> 3)
+    fphase = phase_shift & 0b111
+
+    # CPHASE is only a 7-bit field; so large dividers can't be shifted by much.
+    if cphase > 127:
+        raise ValueError("Unable to shift a divide-by-{} output by {} degrees".format(divider, phase))
+
+    return cphase, fphase
+
+
+# Operating limits of the ECP5's EHXPLLL, in MHz, per the ECP5 datasheet.
+_PLL_INPUT_RANGE  = (8, 400)
+_PLL_PFD_RANGE    = (3.125, 400)
+_PLL_VCO_RANGE    = (400, 800)
+_PLL_OUTPUT_RANGE = (3.125, 400)
+
+# The outputs of the EHXPLLL, in the order we assign them.
+_PLL_OUTPUTS = ("CLKOP", "CLKOS", "CLKOS2", "CLKOS3")
+
+# Charge pump current and loop filter resistor settings for our PLL. These depend on our whole loop
+# configuration -- our PFD frequency and feedback divider, as well as our VCO frequency -- and we
+# only have the settings Clarity Designer generated for our stock configuration: a 60 MHz input,
+# with CLKI_DIV=1, CLKFB_DIV=4, and CLKOP_DIV=2. Any other configuration uses the default settings
+# Trellis' `ecppll` applies.
+_PLL_STOCK_CONFIGURATION          = (60, 1, 4, 2)
+_PLL_STOCK_LOOP_FILTER_SETTINGS   = (9, 8)
+_PLL_DEFAULT_LOOP_FILTER_SETTINGS = (12, 8)
+
+
+@lru_cache(maxsize=None)
+def _search_pll_dividers(input_frequency, output_frequencies, tolerance):
+    """ Searches for the EHXPLLL divider settings that best generate a set of clocks.
+
+    This performs the same search as Trellis' `ecppll`: we look for a VCO frequency
+    inside the PLL's operating range from which each of our outputs can be divided.
+    Results are cached, as the search only depends on its arguments.
+
+    Parameters:
+        input_frequency    -- The frequency of the PLL's reference clock, in MHz.
+        output_frequencies -- A tuple of (output, frequency) pairs; see `_compute_pll_params`.
+        tolerance          -- The maximum relative error permitted for any of our outputs.
+
+    Returns a (clki_div, clkfb_div, f_vco, dividers) tuple, where dividers is a tuple
+    of (output, divider) pairs.
+    """
+
+    if not (_PLL_INPUT_RANGE[0] <= input_frequency <= _PLL_INPUT_RANGE[1]):
+        raise ValueError("Unsupported PLL input frequency {} MHz".format(input_frequency))
+
+    for output, frequency in output_frequencies:
+        if not (_PLL_OUTPUT_RANGE[0] <= frequency <= _PLL_OUTPUT_RANGE[1]):
+            raise ValueError("Unsupported {} frequency {} MHz".format(output, frequency))
+
+    def relative_error(actual, target):
+        return abs(actual - target) / target
+
+    primary_frequency = dict(output_frequencies)["CLKOP"]
+    secondaries = [(output, frequency) for output, frequency in output_frequencies if output != "CLKOP"]
+
+    best = None
+    best_key = None
+
+    for clki_div in range(1, 129):
+        f_pfd = input_frequency / clki_div
+        if not (_PLL_PFD_RANGE[0] <= f_pfd <= _PLL_PFD_RANGE[1]):
+            continue
+
+        for clkfb_div in range(1, 81):
+
+            # Since we feed back from CLKOP, our PFD keeps CLKOP at exactly CLKFB_DIV times
+            # our PFD frequency; so we can quickly discard any pairs that miss our primary output.
+            f_primary = f_pfd * clkfb_div
+            primary_error = relative_error(f_primary, primary_frequency)
+            if primary_error > tolerance:
+                continue
+
+            for clkop_div in range(1, 129):
+                f_vco = f_primary * clkop_div
+                if f_vco < _PLL_VCO_RANGE[0]:
+                    continue
+                if f_vco > _PLL_VCO_RANGE[1]:
+                    break
+
+                # Figure out the divider that gets each of our secondary outputs closest to its target.
+                dividers = [("CLKOP", clkop_div)]
+                errors   = [primary_error]
+                for output, frequency in secondaries:
+                    divider = min(max(round(f_vco / frequency), 1), 128)
+                    dividers.append((output, divider))
+                    errors.append(relative_error(f_vco / divider, frequency))
+
+                # Prefer the most accurate configuration; and among equally accurate ones,
+                # the one whose VCO sits closest to the center of its range.
+                key = (max(errors), abs(f_vco - 600))
+                if best_key is None or key < best_key:
+                    best_key = key
+                    best = (clki_div, clkfb_div, f_vco, tuple(dividers))
+
+    if best is None or best_key[0] > tolerance:
+        raise ValueError("Unable to generate {} from a {} MHz PLL input".format(
+            ", ".join("{} MHz".format(f) for _, f in output_frequencies), input_frequency))
+
+    return best
+
+
+def _compute_pll_params(input_frequency, output_frequencies, *, output_phases=None, tolerance=0.002):
+    """ Computes the parameters needed for an EHXPLLL to generate a set of clocks.
+
+    Parameters:
+        input_frequency    -- The frequency of the PLL's reference clock, in MHz.
+        output_frequencies -- A dictionary mapping PLL output names (e.g. "CLKOP") to the
+                              frequency each should generate, in MHz. CLKOP is used as the
+                              PLL's feedback path, and thus must always be present.
+        output_phases      -- A dictionary mapping PLL output names to the phase shift each should
+                              have, in degrees. Any outputs not present are generated with no shift.
+        tolerance          -- The maximum relative error permitted for any of our outputs.
+
+    Returns a dictionary of EHXPLLL Instance parameters and attributes.
+    """
+
+    if output_phases is None:
+        output_phases = {}
+
+    clki_div, clkfb_div, f_vco, dividers = \
+        _search_pll_dividers(input_frequency, tuple(output_frequencies.items()), tolerance)
+    dividers = dict(dividers)
+
+    # Use Clarity's loop filter settings if we're running our stock configuration; or ecppll's otherwise.
+    if (input_frequency, clki_div, clkfb_div, dividers["CLKOP"]) == _PLL_STOCK_CONFIGURATION:
+        icp_current, lpf_resistor = _PLL_STOCK_LOOP_FILTER_SETTINGS
+    else:
+        icp_current, lpf_resistor = _PLL_DEFAULT_LOOP_FILTER_SETTINGS
+
+    params = {
+        "p_CLKI_DIV":               clki_div,
+        "p_CLKFB_DIV":              clkfb_div,
+        "a_FREQUENCY_PIN_CLKI":     "{:.6f}".format(input_frequency),
+        "a_ICP_CURRENT":            str(icp_current),
+        "a_LPF_RESISTOR":           str(lpf_resistor),
+        "a_MFG_ENABLE_FILTEROPAMP": "1",
+        "a_MFG_GMCREF_SEL":         "2",
+    }
+
+    # Configure each of our outputs; leaving any we're not using disabled.
+    for output in _PLL_OUTPUTS:
+        if output in dividers:
+            divider = dividers[output]
+            cphase, fphase = _compute_pll_phase(divider, phase=output_phases.get(output, 0))
+
+            params[f"p_{output}_ENABLE"] = "ENABLED"
+            params[f"p_{output}_DIV"]    = divider
+            params[f"p_{output}_CPHASE"] = cphase
+            params[f"p_{output}_FPHASE"] = fphase
+            params[f"a_FREQUENCY_PIN_{output}"] = "{:.6f}".format(f_vco / divider)
+        else:
+            params[f"p_{output}_ENABLE"] = "DISABLED"
+            params[f"p_{output}_DIV"]    = 1
+            params[f"p_{output}_CPHASE"] = 0
+            params[f"p_{output}_FPHASE"] = 0
+
+    return params
+
+
 class PHYResetController(Elaboratable):
     """ Gateware that implements a short power-on-reset pulse to reset an attached PHY.
 
@@ -93,15 +277,79 @@ class PHYResetController(Elaboratable):
         return m
 
 
+class PLLLockFilter(Elaboratable):
+    """ Gateware that only considers a PLL locked once it's reported lock for a while.
+
+    This keeps a brief lock indication, e.g. while the PLL's VCO is still settling, from
+    being treated as lock. Losing lock still takes effect immediately.
+
+    Operates in the `sync` domain; which should be a clock that runs even while the PLL
+    isn't locked, such as the PLL's reference clock.
+
+    I/O ports:
+
+        I: pll_lock -- The PLL's raw lock signal. Need not be synchronous to our domain.
+        O: locked   -- Asserted once pll_lock has been seen for debounce_cycles consecutive cycles;
+                       and deasserted as soon as pll_lock is, until it's again been seen for
+                       debounce_cycles consecutive cycles. Even drops in pll_lock shorter than a
+                       cycle restart this count.
+    """
+
+    def __init__(self, *, debounce_cycles=256):
+        """ Params:
+
+            debounce_cycles -- The number of consecutive cycles pll_lock must be seen for
+                               before we consider our PLL locked.
+        """
+
+        self.debounce_cycles = debounce_cycles
+
+        #
+        # I/O port
+        #
+        self.pll_lock = Signal()
+        self.locked   = Signal()
+
+
+    def elaborate(self, platform):
+        m = Module()
+
+        lock_lost   = Signal()
+        lock_cycles = Signal(range(self.debounce_cycles + 1))
+        lock_stable = Signal()
+
+        # Bring our lock signal into our domain before counting it. Any loss of lock is captured
+        # asynchronously, so it's seen immediately, however briefly lock is lost; but lock is only
+        # seen to return synchronously to our domain.
+        m.submodules.lock_synchronizer = \
+            AsyncFFSynchronizer(self.pll_lock, lock_lost, async_edge="neg")
+
+        with m.If(lock_lost):
+            m.d.sync += [
+                lock_cycles  .eq(0),
+                lock_stable  .eq(0),
+            ]
+        with m.Elif(lock_cycles == self.debounce_cycles):
+            m.d.sync += lock_stable.eq(1)
+        with m.Else():
+            m.d.sync += lock_cycles.eq(lock_cycles + 1)
+
+        # Losing lock still takes effect immediately.
+        m.d.comb += self.locked.eq(~lock_lost & lock_stable)
+
+        return m
+
 
 class LunaDomainGenerator(Elaboratable, metaclass=ABCMeta):
     """ Helper that generates the clock domains used in a LUNA board.
 
     Note that this module should create three in-phase clocks; so these domains
-    should not require explicit boundary crossings.
+    should not require explicit boundary crossings. Generators may optionally also
+    provide a `fast_out` domain, which is a phase-shifted copy of the fast clock.
 
     I/O port:
         O: clk_fast      -- The clock signal for our fast clock domain.
+        O: clk_fast_out  -- The clock signal for our phase-shifted fast clock domain; or None if not provided.
         O: clk_sync      -- The clock signal used for our sync clock domain.
         O: clk_usb       -- The clock signal used for our USB domain.
         O: usb_holdoff   -- Signal that indicates that the USB domain is immediately post-reset,
@@ -121,13 +369,34 @@ class LunaDomainGenerator(Elaboratable, metaclass=ABCMeta):
         #
         # I/O port
         #
-        self.clk_fast     = Signal()
-        self.clk_sync     = Signal()
-        self.clk_usb      = Signal()
-
         self.usb_holdoff  = Signal()
 
 
+    # Whether we provide a `fast_out` domain; generators that do should override this.
+    provides_fast_out_domain = False
+
+
+    # Our clock outputs are simply the clocks of our domains.
+    @property
+    def clk_fast(self):
+        return ClockSignal(domain="fast")
+
+    @property
+    def clk_fast_out(self):
+        if not self.provides_fast_out_domain:
+            return None
+
+        return ClockSignal(domain="fast_out")
+
+    @property
+    def clk_sync(self):
+        return ClockSignal(domain="sync")
+
+    @property
+    def clk_usb(self):
+        return ClockSignal(domain="usb")
+
+
     @abstractmethod
     def generate_fast_clock(self, m, platform):
         """ Method that returns our platform's fast clock; used for e.g. RAM interfacing. """
@@ -143,6 +412,11 @@ class LunaDomainGenerator(Elaboratable, metaclass=ABCMeta):
         """ Method that generates a 60MHz clock used for ULPI interfacing. """
 
 
+    def generate_fast_out_clock(self, m, platform):
+        """ Method that returns a phase-shifted copy of our fast clock; or None if we don't provide one. """
+        return None
+
+
     def create_submodules(self, m, platform):
         """ Method hook for creating any necessary submodules before generating clock. """
         pass
@@ -165,24 +439,26 @@ class LunaDomainGenerator(Elaboratable, metaclass=ABCMeta):
         m = Module()
 
         # Create our clock domains.
-        m.domains.fast = self.fast = ClockDomain()
-        m.domains.sync = self.sync = ClockDomain()
+        m.domains.fast = self.fast = ClockDomain(async_reset=True)
+        m.domains.sync = self.sync = ClockDomain(async_reset=True)
         m.domains.usb  = self.usb  = ClockDomain()
 
         # Call the hook that will create any submodules necessary for all clocks.
         self.create_submodules(m, platform)
 
-        # Generate and connect up our clocks.
+        # Generate and connect up our clocks. Each domain's clock is driven directly by its source.
         m.d.comb += [
-            self.clk_usb                   .eq(self.generate_usb_clock(m, platform)),
-            self.clk_sync                  .eq(self.generate_sync_clock(m, platform)),
-            self.clk_fast                  .eq(self.generate_fast_clock(m, platform)),
-
-            ClockSignal(domain="fast")     .eq(self.clk_fast),
-            ClockSignal(domain="sync")     .eq(self.clk_sync),
-            ClockSignal(domain="usb")      .eq(self.clk_usb),
+            ClockSignal(domain="usb")      .eq(self.generate_usb_clock(m, platform)),
+            ClockSignal(domain="sync")     .eq(self.generate_sync_clock(m, platform)),
+            ClockSignal(domain="fast")     .eq(self.generate_fast_clock(m, platform)),
         ]
 
+        # If we have a phase-shifted copy of our fast clock, provide it as its own domain.
+        fast_out_clock = self.generate_fast_out_clock(m, platform)
+        if fast_out_clock is not None:
+            m.domains.fast_out = self.fast_out = ClockDomain(async_reset=True)
+            m.d.comb += ClockSignal(domain="fast_out").eq(fast_out_clock)
+
         # Call the hook that will connect up our reset signals.
         self.create_usb_reset(m, platform)
 
@@ -190,13 +466,14 @@ class LunaDomainGenerator(Elaboratable, metaclass=ABCMeta):
 
 
 class LunaECP5DomainGenerator(LunaDomainGenerator):
-    """ ECP5 clock domain generator for LUNA. Assumes a 60MHz input clock. """
+    """ ECP5 clock domain generator for LUNA. Typically used with a 60MHz input clock. """
 
     # For debugging, we'll allow the ECP5's onboard clock to generate a 62MHz
     # oscillator signal. This won't work for USB, but it'll at least allow
     # running some basic self-tests. The clock is 310 MHz by default, so
     # dividing by 5 will yield 62MHz.
-    OSCG_DIV = 5
+    OSCG_FREQUENCY_MHZ = 310
+    OSCG_DIV           = 5
 
     # Quick configuration selection
     DEFAULT_CLOCK_FREQUENCIES_MHZ = {
@@ -205,17 +482,60 @@ class LunaECP5DomainGenerator(LunaDomainGenerator):
         "usb":  60
     }
 
-    def __init__(self, *, clock_frequencies=None, clock_signal_name=None, clock_signal_frequency=None):
+    def __init__(self, *, clock_frequencies=None, clock_signal_name=None, clock_signal_frequency=None,
+            fast_out_phase=None, pll_site=None, lock_debounce_cycles=256,
+            bypass_pll_for_input_frequency=False):
         """
         Parameters:
-            clock_frequencies -- A dictionary mapping 'fast', 'sync', and 'usb' to the clock
-                                 frequencies for those domains, in MHz. Valid choices for each
-                                 domain are 60, 120, and 240. If not provided, fast will be
-                                 assumed to be 240, sync will assumed to be 120, and usb will
-                                 be assumed to be a standard 60.
+            clock_frequencies      -- A dictionary mapping 'fast', 'sync', and 'usb' to the clock
+                                      frequencies for those domains, in MHz. Any set of frequencies
+                                      the PLL can derive from a single VCO frequency may be used.
+                                      If not provided, fast will be assumed to be 240, sync will
+                                      assumed to be 120, and usb will be assumed to be a standard 60.
+            fast_out_phase         -- If provided, a `fast_out` domain will also be generated, running
+                                      at the fast domain's frequency, but shifted by the given phase,
+                                      in degrees (e.g. 180). It's generated by the PLL's CLKOS3 output.
+            pll_site               -- If provided, the PLL site our PLL should be placed at; allowing boards
+                                      to keep it beside their clock input and the global clock network.
+                                      With the Trellis toolchain, this is a full nextpnr BEL name, in the
+                                      form X<x>/Y<y>/EHXPLL_<UL|UR|LL|LR>; with Diamond, it's a site name,
+                                      such as PLL_BR0. If not provided, the PLL is placed by the toolchain.
+            lock_debounce_cycles   -- The number of consecutive input clock cycles our PLL must report
+                                      lock for before our domains are released from reset; or 0 to use
+                                      the PLL's lock signal directly.
+            bypass_pll_for_input_frequency -- If True, any domains running at our input clock's frequency
+                                      are clocked directly from our input clock, rather than from a PLL
+                                      output. This saves a PLL output, but those domains are then no longer
+                                      in phase with our PLL-generated domains; as the PLL can't compensate
+                                      for the input clock's own routing, they lag by its global clock path's
+                                      delay. Any signals crossing between them must be synchronized.
         """
         super().__init__(clock_signal_name=clock_signal_name, clock_signal_frequency=clock_signal_frequency)
-        self.clock_frequencies = clock_frequencies
+        self.clock_frequencies    = clock_frequencies
+        self.fast_out_phase       = fast_out_phase
+        self.pll_site             = pll_site
+        self.lock_debounce_cycles = lock_debounce_cycles
+        self.bypass_pll           = bypass_pll_for_input_frequency
+
+        # We can't know how to carry strobes from our sync domain into our USB domain until we know
+        # our final clock frequencies; so any strobes requested before we're elaborated are recorded
+        # here, and their crossings are created once we are. See stretch_sync_strobe_to_usb.
+        self._sync_to_usb_cycles  = None
+        self._pending_usb_strobes = []
+
+
+    @staticmethod
+    def _compute_sync_to_usb_cycles(clock_frequencies):
+        """ Returns the number of sync cycles a strobe must last to be seen in the USB domain.
+
+        If our sync clock is an integer multiple of our (in-phase) USB clock, we can just stretch
+        strobes across enough sync cycles to be seen in the USB domain; otherwise, we'll need a
+        pulse synchronizer, and this returns None.
+        """
+        if clock_frequencies['sync'] % clock_frequencies['usb'] == 0:
+            return clock_frequencies['sync'] // clock_frequencies['usb']
+        else:
+            return None
 
 
     def create_submodules(self, m, platform):
@@ -236,20 +556,6 @@ class LunaECP5DomainGenerator(LunaDomainGenerator):
         clock_name = self.clock_name if self.clock_name else platform.default_clk
         clock_frequency = self.clock_frequency if self.clock_name else platform.default_clk_frequency
 
-        # Create absolute-frequency copies of our PLL outputs.
-        # We'll use the generate_ methods below to select which domains
-        # apply to which components.
-        self._clk_240MHz = Signal()
-        self._clk_120MHz = Signal()
-        self._clk_60MHz  = Signal()
-        self._clock_options = {
-            60:  self._clk_60MHz,
-            120: self._clk_120MHz,
-            240: self._clk_240MHz
-        }
-
-        pll_params = {}
-
         # Grab our input clock
         # For debugging: if our clock name is "OSCG", allow using the internal
         # oscillator. This is mostly useful for debugging.
@@ -259,122 +565,236 @@ class LunaECP5DomainGenerator(LunaDomainGenerator):
 
             input_clock = Signal()
             m.submodules += Instance("OSCG", p_DIV=self.OSCG_DIV, o_OSC=input_clock)
-            pll_params["CLKFB_DIV"] = 4
+            input_frequency = self.OSCG_FREQUENCY_MHZ / self.OSCG_DIV
         else:
             input_clock = platform.request(clock_name).i
+            input_frequency = clock_frequency / 1e6
+
+        # Each distinct frequency used by our domains gets its own PLL output, fastest first; so all
+        # of our domains are generated in phase with each other. If we've been asked to, any domains
+        # that run at our input frequency instead use our input clock directly, rather than taking up
+        # a PLL output; see bypass_pll_for_input_frequency. We'll use the generate_ methods below to
+        # select which domains apply to which components.
+        frequencies     = sorted({self.clock_frequencies[domain] for domain in ("fast", "sync", "usb")}, reverse=True)
+        pll_frequencies = frequencies
+        if self.bypass_pll:
+            pll_frequencies = [frequency for frequency in frequencies if frequency != input_frequency]
+
+        # If we're generating a phase-shifted fast clock, our PLL will need a copy of our fast
+        # clock to feed back from; so we'll generate the fast clock in our PLL, too.
+        if self.fast_out_phase is not None and not pll_frequencies:
+            pll_frequencies = [self.clock_frequencies["fast"]]
+
+        pll_outputs = dict(zip(_PLL_OUTPUTS, pll_frequencies))
+        pll_clocks  = {output: Signal(name=f"clk_{frequency}MHz") for output, frequency in pll_outputs.items()}
+        pll_phases  = {}
+
+        self._clock_options = {frequency: input_clock for frequency in frequencies}
+        self._clock_options.update({frequency: pll_clocks[output] for output, frequency in pll_outputs.items()})
+
+        # Resolve the clock for each of our domains once, in (fast, sync, usb) order.
+        self._resolved_clocks = tuple(self._clock_options[self.clock_frequencies[domain]]
+                for domain in ("fast", "sync", "usb"))
+
+        # Strobes can only be stretched between in-phase clocks. If only one of our sync and usb
+        # clocks bypasses our PLL, the two aren't in phase; so strobes must be synchronized instead.
+        sync_clock, usb_clock = self._resolved_clocks[1:]
+        if (sync_clock is input_clock) == (usb_clock is input_clock):
+            self._sync_to_usb_cycles = self._compute_sync_to_usb_cycles(self.clock_frequencies)
+        else:
+            self._sync_to_usb_cycles = None
+
+        # If we've been asked for a phase-shifted fast clock, generate it on our otherwise unused
+        # CLKOS3 output; this keeps it on a dedicated PLL output, rather than inverting a clock in fabric.
+        if self.fast_out_phase is not None:
+            self._clk_fast_out_shifted = Signal()
+
+            pll_outputs["CLKOS3"] = self.clock_frequencies["fast"]
+            pll_clocks["CLKOS3"]  = self._clk_fast_out_shifted
+            pll_phases["CLKOS3"]  = self.fast_out_phase
 
-            divisor = 240e6 / clock_frequency
-            if not divisor.is_integer():
-                raise ValueError("Unsupported clock frequency {} MHz, must be an integer divisor of 240 MHz"
-                                 .format(clock_frequency/1e6))
-
-            pll_params["CLKFB_DIV"] = int(divisor)
-
-        # Instantiate the ECP5 PLL.
-        # These constants generated by Clarity Designer; which will
-        # ideally be replaced by an open-source component.
-        # (see https://github.com/SymbiFlow/prjtrellis/issues/34.)
-        m.submodules.pll = Instance("EHXPLLL",
-
-                # Clock in.
-                i_CLKI=input_clock,
-
-                # Generated clock outputs.
-                o_CLKOP=self._clk_240MHz,
-                o_CLKOS=self._clk_120MHz,
-                o_CLKOS2=self._clk_60MHz,
-
-                # Status.
-                o_LOCK=self._pll_lock,
-
-                # PLL parameters...
-                p_PLLRST_ENA="DISABLED",
-                p_INTFB_WAKE="DISABLED",
-                p_STDBY_ENABLE="DISABLED",
-                p_DPHASE_SOURCE="DISABLED",
-                p_CLKOS3_FPHASE=0,
-                p_CLKOS3_CPHASE=0,
-                p_CLKOS2_FPHASE=0,
-                p_CLKOS2_CPHASE=7,
-                p_CLKOS_FPHASE=0,
-                p_CLKOS_CPHASE=3,
-                p_CLKOP_FPHASE=0,
-                p_CLKOP_CPHASE=1,
-                p_PLL_LOCK_MODE=0,
-                p_CLKOS_TRIM_DELAY="0",
-                p_CLKOS_TRIM_POL="FALLING",
-                p_CLKOP_TRIM_DELAY="0",
-                p_CLKOP_TRIM_POL="FALLING",
-                p_OUTDIVIDER_MUXD="DIVD",
-                p_CLKOS3_ENABLE="DISABLED",
-                p_OUTDIVIDER_MUXC="DIVC",
-                p_CLKOS2_ENABLE="ENABLED",
-                p_OUTDIVIDER_MUXB="DIVB",
-                p_CLKOS_ENABLE="ENABLED",
-                p_OUTDIVIDER_MUXA="DIVA",
-                p_CLKOP_ENABLE="ENABLED",
-                p_CLKOS3_DIV=1,
-                p_CLKOS2_DIV=8,
-                p_CLKOS_DIV=4,
-                p_CLKOP_DIV=2,
-                p_CLKFB_DIV=pll_params["CLKFB_DIV"],
-                p_CLKI_DIV=1,
-                p_FEEDBK_PATH="CLKOP",
-
-                # Internal feedback.
-                i_CLKFB=self._clk_240MHz,
-
-                # Control signals.
-                i_RST=0,
-                i_PHASESEL0=0,
-                i_PHASESEL1=0,
-                i_PHASEDIR=0,
-                i_PHASESTEP=0,
-                i_PHASELOADREG=0,
-                i_STDBY=0,
-                i_PLLWAKESYNC=0,
-
-                # Output Enables.
-                i_ENCLKOP=0,
-                i_ENCLKOS=0,
-                i_ENCLKOS2=0,
-                i_ENCLKOS3=0,
-
-                # Synthesis attributes.
-                a_FREQUENCY_PIN_CLKI="60.000000",
-                a_FREQUENCY_PIN_CLKOS2="60.000000",
-                a_FREQUENCY_PIN_CLKOS="120.000000",
-                a_FREQUENCY_PIN_CLKOP="240.000000",
-                a_ICP_CURRENT="9",
-                a_LPF_RESISTOR="8"
-        )
+        # If all of our domains run directly from our input clock, we don't need a PLL at all.
+        if not pll_outputs:
+            m.d.comb += self._pll_lock.eq(1)
 
+        else:
+            pll_lock = Signal()
+
+            # Figure out the dividers necessary to generate each of our clocks.
+            pll_params = _compute_pll_params(input_frequency, pll_outputs, output_phases=pll_phases)
+
+            # If we've been given a site for our PLL, constrain it there. nextpnr and Diamond each
+            # name, and constrain, their PLL sites differently.
+            if self.pll_site is not None:
+                if platform.toolchain == "Diamond":
+                    pll_params["a_LOC"] = self.pll_site
+                elif re.fullmatch(r"X\d+/Y\d+/EHXPLL_(UL|UR|LL|LR)", self.pll_site):
+                    pll_params["a_BEL"] = self.pll_site
+                else:
+                    raise ValueError("PLL site {} isn't a nextpnr PLL BEL name (X<x>/Y<y>/EHXPLL_<corner>)"
+                        .format(self.pll_site))
+
+            # If any of our domains run directly from our input clock, we'll feed back from CLKOP's
+            # clock net, so the PLL compensates for CLKOP's routing and aligns it with our input clock at
+            # the PLL's CLKI pin. This reduces, but doesn't remove, the skew to our bypassed domains, whose
+            # input clock takes its own, uncompensated path. Otherwise, we only need our outputs aligned
+            # with each other; so we can use the PLL's internal feedback path, and skip routing feedback
+            # through the fabric.
+            if any(clock is input_clock for clock in self._clock_options.values()):
+                pll_params["p_FEEDBK_PATH"] = "CLKOP"
+                pll_params["i_CLKFB"]       = pll_clocks["CLKOP"]
+            else:
+                feedback = Signal()
+                pll_params["p_FEEDBK_PATH"] = "INT_OP"
+                pll_params["o_CLKINTFB"]    = feedback
+                pll_params["i_CLKFB"]       = feedback
+
+            # Instantiate the ECP5 PLL.
+            # Our dividers and phases are computed above; the remaining constants
+            # were generated by Clarity Designer.
+            m.submodules.pll = Instance("EHXPLLL",
+
+                    # Clock in.
+                    i_CLKI=input_clock,
+
+                    # Generated clock outputs.
+                    **{f"o_{output}": clock for output, clock in pll_clocks.items()},
+
+                    # Status.
+                    o_LOCK=pll_lock,
+
+                    # PLL parameters...
+                    p_PLLRST_ENA="DISABLED",
+                    p_INTFB_WAKE="DISABLED",
+                    p_STDBY_ENABLE="DISABLED",
+                    p_DPHASE_SOURCE="DISABLED",
+                    p_PLL_LOCK_MODE=2,
+                    p_CLKOS_TRIM_DELAY="0",
+                    p_CLKOS_TRIM_POL="FALLING",
+                    p_CLKOP_TRIM_DELAY="0",
+                    p_CLKOP_TRIM_POL="FALLING",
+                    p_OUTDIVIDER_MUXD="DIVD",
+                    p_OUTDIVIDER_MUXC="DIVC",
+                    p_OUTDIVIDER_MUXB="DIVB",
+                    p_OUTDIVIDER_MUXA="DIVA",
+
+                    # Control signals.
+                    i_RST=0,
+                    i_PHASESEL0=0,
+                    i_PHASESEL1=0,
+                    i_PHASEDIR=0,
+                    i_PHASESTEP=0,
+                    i_PHASELOADREG=0,
+                    i_STDBY=0,
+                    i_PLLWAKESYNC=0,
+
+                    # Output Enables.
+                    i_ENCLKOP=0,
+                    i_ENCLKOS=0,
+                    i_ENCLKOS2=0,
+                    i_ENCLKOS3=0,
+
+                    # Dividers, phases, feedback, loop filter settings, frequency annotations, and placement.
+                    **pll_params
+            )
+
+            # Explicitly constrain each of our generated clocks. nextpnr already derives these
+            # periods from our PLL's dividers; this just restates them, so our intended frequencies
+            # are recorded alongside our design for any toolchain that doesn't.
+            for output, clock in pll_clocks.items():
+                frequency = float(pll_params[f"a_FREQUENCY_PIN_{output}"]) * 1e6
+                platform.add_clock_constraint(clock, frequency)
+
+            # Only consider our PLL locked once it's reported lock for a while, so a brief lock
+            # indication while our VCO is still settling doesn't release our resets. We count in
+            # our input clock's domain, as it's running even while our PLL isn't locked.
+            if self.lock_debounce_cycles:
+                m.domains.pll_reference = ClockDomain(local=True, reset_less=True)
+                m.d.comb += ClockSignal("pll_reference").eq(input_clock)
+
+                lock_filter = PLLLockFilter(debounce_cycles=self.lock_debounce_cycles)
+                m.submodules.lock_filter = DomainRenamer({"sync": "pll_reference"})(lock_filter)
+                m.d.comb += [
+                    lock_filter.pll_lock  .eq(pll_lock),
+                    self._pll_lock        .eq(lock_filter.locked),
+                ]
+            else:
+                m.d.comb += self._pll_lock.eq(pll_lock)
 
         # Set up our global resets so the system is kept fully in reset until
         # our core PLL is fully stable. This prevents us from internally clock
         # glitching ourselves before our PLL is locked. :)
-        m.d.comb += [
-            ResetSignal("sync").eq(~self._pll_lock),
-            ResetSignal("fast").eq(~self._pll_lock),
-        ]
+        #
+        # Losing lock asserts each reset immediately; but each is only released
+        # synchronously to its own domain's clock, so no flop sees a reset edge
+        # close to one of its clock edges.
+        m.submodules.sync_reset = ResetSynchronizer(~self._pll_lock, domain="sync")
+        m.submodules.fast_reset = ResetSynchronizer(~self._pll_lock, domain="fast")
+        if self.fast_out_phase is not None:
+            m.submodules.fast_out_reset = ResetSynchronizer(~self._pll_lock, domain="fast_out")
+
+        # Now that we know our final clock frequencies, create any strobe crossings we've been asked for.
+        for strobe, output, allow_delay in self._pending_usb_strobes:
+            self._create_usb_strobe_crossing(m, strobe, output, allow_delay)
+        self._pending_usb_strobes = None
+
+
+    @property
+    def provides_fast_out_domain(self):
+        return self.fast_out_phase is not None
 
 
     def generate_usb_clock(self, m, platform):
-        return self._clock_options[self.clock_frequencies['usb']]
+        return self._resolved_clocks[2]
 
     def generate_sync_clock(self, m, platform):
-        return self._clock_options[self.clock_frequencies['sync']]
+        return self._resolved_clocks[1]
 
     def generate_fast_clock(self, m, platform):
-        return self._clock_options[self.clock_frequencies['fast']]
+        return self._resolved_clocks[0]
+
+    def generate_fast_out_clock(self, m, platform):
+        if self.fast_out_phase is None:
+            return None
+
+        return self._clk_fast_out_shifted
 
 
     def stretch_sync_strobe_to_usb(self, m, strobe, output=None, allow_delay=False):
         """
-        Helper that stretches a strobe from the `sync` domain to communicate with the `usn` domain.
-        Works for any chosen frequency in which f(usb) < f(sync).
+        Helper that stretches a strobe from the `sync` domain to communicate with the `usb` domain.
+
+        If f(sync) is an integer multiple of f(usb), the strobe is stretched in the `sync` domain.
+        Otherwise, it's carried across by a pulse synchronizer, and the output is a single-cycle
+        strobe in the `usb` domain; in this case, strobes must be at least f(sync)/f(usb) cycles apart.
+
+        Our final clock frequencies aren't known until we're elaborated; so if this is called before
+        then, the crossing is created as part of this generator, rather than in the provided module.
         """
 
-        # TODO: replace with Amaranth's pulsesynchronizer?
-        to_cycles = self.clock_frequencies['sync'] // self.clock_frequencies['usb']
-        return stretch_strobe_signal(m, strobe, output=output, to_cycles=to_cycles, allow_delay=allow_delay)
+        # If we're not given an output signal to target, create one.
+        if output is None:
+            output = Signal()
+
+        if self._pending_usb_strobes is not None:
+            self._pending_usb_strobes.append((strobe, output, allow_delay))
+        else:
+            self._create_usb_strobe_crossing(m, strobe, output, allow_delay)
+
+        return output
+
+
+    def _create_usb_strobe_crossing(self, m, strobe, output, allow_delay):
+        """ Creates the logic that carries a strobe from our `sync` domain into our `usb` domain. """
+
+        if self._sync_to_usb_cycles is not None:
+            stretch_strobe_signal(m, strobe, output=output, to_cycles=self._sync_to_usb_cycles,
+                allow_delay=allow_delay)
+            return
+
+        synchronizer = PulseSynchronizer(i_domain="sync", o_domain="usb")
+        m.submodules += synchronizer
+        m.d.comb += [
+            synchronizer.i  .eq(strobe),
+            output          .eq(synchronizer.o)
+        ]
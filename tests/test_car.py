@@ -1,11 +1,43 @@
+# amaranth: UnusedElaboratable=no
 #
 # This file is part of LUNA.
 #
 # Copyright (c) 2024 Great Scott Gadgets <info@greatscottgadgets.com>
 # SPDX-License-Identifier: BSD-3-Clause
+from unittest import TestCase
+
+from amaranth          import Signal, Module, Elaboratable, Fragment
+from amaranth.hdl.ast  import Assign, ResetSignal, SignalDict
+from amaranth.build    import Resource, Pins, Clock, Attrs
+from amaranth.vendor   import LatticeECP5Platform
+
 from luna.gateware.test import LunaGatewareTestCase, sync_test_case
 
-from luna.gateware.architecture.car import PHYResetController
+from amaranth.sim      import Settle, Delay
+
+from luna.gateware.architecture.car import PHYResetController, PLLLockFilter, LunaECP5DomainGenerator
+from luna.gateware.architecture.car import _compute_pll_phase, _compute_pll_params
+
+
+class StubECP5Platform(LatticeECP5Platform):
+    """ Minimal ECP5 platform, with just a 60MHz clock input; sufficient to elaborate our domain generator. """
+
+    device      = "LFE5U-25F"
+    package     = "BG256"
+    speed       = "6"
+
+    default_clk = "clk60"
+    resources   = [
+        Resource("clk60", 0, Pins("P6", dir="i"), Clock(60e6), Attrs(IO_TYPE="LVCMOS33")),
+    ]
+    connectors  = []
+
+    DEFAULT_CLOCK_FREQUENCIES_MHZ = {
+        "fast": 240,
+        "sync": 120,
+        "usb":  60
+    }
+
 
 class PHYResetControllerTest(LunaGatewareTestCase):
     FRAGMENT_UNDER_TEST = PHYResetController
@@ -37,3 +69,459 @@ class PHYResetControllerTest(LunaGatewareTestCase):
 
         yield from self.advance_cycles(120)
         self.assertEqual((yield self.dut.phy_stop),  0)
+
+
+class PLLLockFilterTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = PLLLockFilter
+    FRAGMENT_ARGUMENTS  = dict(debounce_cycles=16)
+
+    def initialize_signals(self):
+        yield self.dut.pll_lock.eq(0)
+
+    def wait_for_lock(self):
+        """ Asserts that our filter reports lock only after our PLL's been locked for long enough. """
+
+        # Our lock should be held off for our full debounce period, plus a few cycles of latency...
+        for _ in range(16 + 3):
+            yield
+            self.assertEqual((yield self.dut.locked), 0)
+
+        # ... and then be reported.
+        yield
+        self.assertEqual((yield self.dut.locked), 1)
+
+    @sync_test_case
+    def test_lock_debouncing(self):
+        yield from self.advance_cycles(4)
+        self.assertEqual((yield self.dut.locked), 0)
+
+        yield self.dut.pll_lock.eq(1)
+        yield from self.wait_for_lock()
+
+        # Once we're locked, we should stay locked.
+        yield from self.advance_cycles(32)
+        self.assertEqual((yield self.dut.locked), 1)
+
+    @sync_test_case
+    def test_lock_drop_restarts_count(self):
+        yield self.dut.pll_lock.eq(1)
+        yield from self.advance_cycles(12)
+
+        # A brief loss of lock partway through our debounce period should restart our count.
+        yield self.dut.pll_lock.eq(0)
+        yield from self.advance_cycles(4)
+        yield self.dut.pll_lock.eq(1)
+        yield from self.wait_for_lock()
+
+    @sync_test_case
+    def test_single_cycle_lock_drop(self):
+        yield self.dut.pll_lock.eq(1)
+        yield from self.wait_for_lock()
+
+        # Even a single-cycle loss of lock should hold off lock for a full debounce period,
+        # without our lock briefly returning in between.
+        yield self.dut.pll_lock.eq(0)
+        yield
+        yield self.dut.pll_lock.eq(1)
+        yield from self.wait_for_lock()
+
+    @sync_test_case
+    def test_brief_lock_drop(self):
+        yield self.dut.pll_lock.eq(1)
+        yield from self.wait_for_lock()
+
+        # A loss of lock too short to be sampled by our clock should still be caught.
+        yield self.dut.pll_lock.eq(0)
+        yield Delay(1e-9)
+        yield Settle()
+        self.assertEqual((yield self.dut.locked), 0)
+
+        yield self.dut.pll_lock.eq(1)
+        yield from self.wait_for_lock()
+
+    @sync_test_case
+    def test_lock_loss_is_immediate(self):
+        yield self.dut.pll_lock.eq(1)
+        yield from self.wait_for_lock()
+
+        # Losing lock should be reflected in the same cycle.
+        yield self.dut.pll_lock.eq(0)
+        yield Settle()
+        self.assertEqual((yield self.dut.locked), 0)
+
+
+class PLLPhaseTest(TestCase):
+
+    def test_zero_phase(self):
+        # A zero-degree shift should place CPHASE at (divider - 1), as Clarity Designer does.
+        self.assertEqual(_compute_pll_phase(2), (1, 0))
+        self.assertEqual(_compute_pll_phase(4), (3, 0))
+        self.assertEqual(_compute_pll_phase(8), (7, 0))
+
+    def test_half_cycle_phase(self):
+        self.assertEqual(_compute_pll_phase(2, phase=180), (2, 0))
+        self.assertEqual(_compute_pll_phase(4, phase=180), (5, 0))
+        self.assertEqual(_compute_pll_phase(1, phase=180), (0, 4))
+
+    def test_fine_phase(self):
+        # 45 degrees of a divide-by-one output is exactly one eighth of a VCO cycle...
+        self.assertEqual(_compute_pll_phase(1, phase=45), (0, 1))
+
+        # ... and finer shifts should be rounded to the nearest eighth.
+        self.assertEqual(_compute_pll_phase(1, phase=30), (0, 1))
+        self.assertEqual(_compute_pll_phase(1, phase=20), (0, 0))
+
+    def test_phase_wraps(self):
+        self.assertEqual(_compute_pll_phase(4, phase=360), _compute_pll_phase(4, phase=0))
+        self.assertEqual(_compute_pll_phase(4, phase=-90), _compute_pll_phase(4, phase=270))
+
+    def test_unreachable_phase(self):
+        # CPHASE is a 7-bit field; so we can't shift a divide-by-128 output by half a cycle.
+        self.assertEqual(_compute_pll_phase(128), (127, 0))
+        with self.assertRaises(ValueError):
+            _compute_pll_phase(128, phase=180)
+
+
+class PLLParameterTest(TestCase):
+
+    def test_default_frequencies(self):
+        # Our standard 60 MHz configuration should match the settings generated by Clarity Designer.
+        params = _compute_pll_params(60, {"CLKOP": 240, "CLKOS": 120, "CLKOS2": 60})
+
+        self.assertEqual(params["p_CLKI_DIV"],   1)
+        self.assertEqual(params["p_CLKFB_DIV"],  4)
+        self.assertEqual(params["p_CLKOP_DIV"],  2)
+        self.assertEqual(params["p_CLKOS_DIV"],  4)
+        self.assertEqual(params["p_CLKOS2_DIV"], 8)
+        self.assertEqual(params["p_CLKOS3_ENABLE"], "DISABLED")
+        self.assertEqual(params["a_FREQUENCY_PIN_CLKOS2"], "60.000000")
+        self.assertEqual(params["a_ICP_CURRENT"],  "9")
+        self.assertEqual(params["a_LPF_RESISTOR"], "8")
+
+    def test_other_input_frequency(self):
+        params = _compute_pll_params(12, {"CLKOP": 240, "CLKOS": 60})
+
+        self.assertEqual(params["p_CLKFB_DIV"], 20)
+        self.assertEqual(params["a_FREQUENCY_PIN_CLKOP"], "240.000000")
+        self.assertEqual(params["a_FREQUENCY_PIN_CLKOS"], "60.000000")
+        self.assertEqual(params["p_CLKOS2_ENABLE"], "DISABLED")
+
+    def test_phase_shifted_output(self):
+        params = _compute_pll_params(60, {"CLKOP": 240, "CLKOS3": 240}, output_phases={"CLKOS3": 180})
+
+        self.assertEqual(params["p_CLKOP_CPHASE"],  1)
+        self.assertEqual(params["p_CLKOS3_DIV"],    2)
+        self.assertEqual(params["p_CLKOS3_CPHASE"], 2)
+        self.assertEqual(params["p_CLKOS3_FPHASE"], 0)
+
+    def test_loop_filter_settings(self):
+        # Only our stock configuration uses Clarity's settings; anything else gets ecppll's defaults.
+        params = _compute_pll_params(60, {"CLKOP": 100})
+
+        self.assertEqual(params["p_CLKOP_DIV"],    6)
+        self.assertEqual(params["a_ICP_CURRENT"],  "12")
+        self.assertEqual(params["a_LPF_RESISTOR"], "8")
+
+        # That includes configurations that happen to land near our stock VCO frequency, such as
+        # the ~62 MHz internal oscillator's; which divides its input down to a much slower PFD.
+        params = _compute_pll_params(62, {"CLKOP": 240, "CLKOS": 120, "CLKOS2": 60})
+
+        self.assertEqual(params["p_CLKI_DIV"],     8)
+        self.assertEqual(params["p_CLKFB_DIV"],    31)
+        self.assertEqual(params["a_ICP_CURRENT"],  "12")
+
+    def test_unreachable_frequencies(self):
+        with self.assertRaises(ValueError):
+            _compute_pll_params(60, {"CLKOP": 240, "CLKOS": 400})
+
+        with self.assertRaises(ValueError):
+            _compute_pll_params(1, {"CLKOP": 240})
+
+
+class SyncToUSBStrobeHarness(Elaboratable):
+    """ Harness that counts the USB-domain events produced by LunaECP5DomainGenerator's strobe crossings.
+
+    Our generator can't be simulated itself, as it instantiates a PLL; so we create its crossing
+    directly, as it would once it's elaborated with the given clock frequencies.
+    """
+
+    def __init__(self, clock_frequencies):
+        self.clock_frequencies = clock_frequencies
+        self.generator         = LunaECP5DomainGenerator(clock_frequencies=clock_frequencies)
+
+        self.strobe     = Signal()
+        self.usb_events = Signal(8)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        usb_strobe = Signal()
+        self.generator._sync_to_usb_cycles = \
+            LunaECP5DomainGenerator._compute_sync_to_usb_cycles(self.clock_frequencies)
+        self.generator._create_usb_strobe_crossing(m, self.strobe, usb_strobe, allow_delay=False)
+
+        with m.If(usb_strobe):
+            m.d.usb += self.usb_events.eq(self.usb_events + 1)
+
+        return m
+
+
+class StretchSyncStrobeTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = SyncToUSBStrobeHarness
+    FRAGMENT_ARGUMENTS  = dict(clock_frequencies={"fast": 240, "sync": 120, "usb": 60})
+
+    SYNC_CLOCK_FREQUENCY = 120e6
+    USB_CLOCK_FREQUENCY  = 60e6
+
+    @sync_test_case
+    def test_strobe_stretching(self):
+        self.assertEqual(self.dut.generator._sync_to_usb_cycles, 2)
+
+        # Each single-cycle sync strobe should be seen exactly once in our USB domain.
+        yield from self.pulse(self.dut.strobe)
+        yield from self.advance_cycles(8)
+        self.assertEqual((yield self.dut.usb_events), 1)
+
+        yield from self.pulse(self.dut.strobe)
+        yield from self.advance_cycles(8)
+        self.assertEqual((yield self.dut.usb_events), 2)
+
+
+class PulseSynchronizedStrobeTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = SyncToUSBStrobeHarness
+    FRAGMENT_ARGUMENTS  = dict(clock_frequencies={"fast": 240, "sync": 120, "usb": 90})
+
+    SYNC_CLOCK_FREQUENCY = 120e6
+    USB_CLOCK_FREQUENCY  = 90e6
+
+    @sync_test_case
+    def test_strobe_synchronization(self):
+        self.assertIsNone(self.dut.generator._sync_to_usb_cycles)
+
+        # Each single-cycle sync strobe should be seen exactly once in our USB domain.
+        yield from self.pulse(self.dut.strobe)
+        yield from self.advance_cycles(8)
+        self.assertEqual((yield self.dut.usb_events), 1)
+
+        yield from self.pulse(self.dut.strobe)
+        yield from self.advance_cycles(8)
+        self.assertEqual((yield self.dut.usb_events), 2)
+
+
+class FragmentCapture(Elaboratable):
+    """ Wrapper that keeps the fragment an elaboratable produces; so it can be inspected after platform.prepare. """
+
+    def __init__(self, elaboratable):
+        self.elaboratable = elaboratable
+        self.fragment     = None
+
+    def elaborate(self, platform):
+        self.fragment = Fragment.get(self.elaboratable, platform)
+        return self.fragment
+
+
+class StrobeCrossingTop(Elaboratable):
+    """ Top-level module that requests a strobe crossing from its domain generator before it's elaborated. """
+
+    def __init__(self, **kwargs):
+        self.car        = LunaECP5DomainGenerator(**kwargs)
+
+        self.strobe     = Signal()
+        self.usb_strobe = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.car = self.car
+        self.car.stretch_sync_strobe_to_usb(m, self.strobe, output=self.usb_strobe)
+        return m
+
+
+class LunaECP5DomainGeneratorTest(TestCase):
+
+    def elaborate(self, platform=None, **kwargs):
+        """ Elaborates a domain generator with the given arguments; returning the generator and its fragment. """
+        platform  = platform or StubECP5Platform()
+        generator = LunaECP5DomainGenerator(**kwargs)
+        fragment  = Fragment.get(generator, platform)
+        return generator, fragment
+
+    def find_pll(self, fragment):
+        """ Returns the EHXPLLL instance in a given elaborated generator; or None if there isn't one. """
+        for subfragment, name in fragment.subfragments:
+            if name == "pll":
+                return subfragment
+        return None
+
+    def test_default_configuration(self):
+        # By default, all of our domains should be generated by our PLL, so they're all in phase.
+        generator, fragment = self.elaborate()
+        pll = self.find_pll(fragment)
+
+        self.assertEqual(pll.parameters["CLKOP_DIV"],  2)
+        self.assertEqual(pll.parameters["CLKOS_DIV"],  4)
+        self.assertEqual(pll.parameters["CLKOS2_DIV"], 8)
+        self.assertEqual(pll.parameters["CLKOS3_ENABLE"], "DISABLED")
+        self.assertIs(generator._resolved_clocks[2], pll.named_ports["CLKOS2"][0])
+
+    def test_input_frequency_bypass(self):
+        # If requested, our 60MHz USB domain should run straight from our input clock instead.
+        generator, fragment = self.elaborate(bypass_pll_for_input_frequency=True)
+        pll = self.find_pll(fragment)
+
+        self.assertEqual(pll.parameters["CLKOS2_ENABLE"], "DISABLED")
+        self.assertNotIn("CLKOS2", pll.named_ports)
+        self.assertIs(generator._resolved_clocks[2], pll.named_ports["CLKI"][0])
+
+    def find_subfragment(self, fragment, name):
+        """ Returns the subfragment of a given fragment with the given name. """
+        for subfragment, subfragment_name in fragment.subfragments:
+            if subfragment_name == name:
+                return subfragment
+        self.fail(f"no subfragment named {name}")
+
+    def test_domain_resets(self):
+        _, fragment = self.elaborate()
+
+        # Our PLL-derived domains should be reset asynchronously, and released synchronously
+        # by a reset synchronizer in each domain.
+        for domain in ("sync", "fast"):
+            self.assertTrue(fragment.domains[domain].async_reset)
+
+            synchronizer = self.find_subfragment(fragment, f"{domain}_reset")
+            reset_drivers = [statement for statement in synchronizer.statements
+                if isinstance(statement, Assign) and isinstance(statement.lhs, ResetSignal)
+                    and statement.lhs.domain == domain]
+            self.assertEqual(len(reset_drivers), 1)
+
+    def test_clock_constraints(self):
+        platform = StubECP5Platform()
+        capture  = FragmentCapture(LunaECP5DomainGenerator(fast_out_phase=180))
+        platform.prepare(capture)
+
+        pll = self.find_pll(capture.fragment)
+        constraints = SignalDict((net, frequency) for net, _, frequency in platform.iter_clock_constraints())
+
+        # Each of our enabled PLL outputs should be constrained to its annotated frequency.
+        for output in ("CLKOP", "CLKOS", "CLKOS2", "CLKOS3"):
+            self.assertEqual(pll.parameters[f"{output}_ENABLE"], "ENABLED")
+
+            clock = pll.named_ports[output][0]
+            self.assertIn(clock, constraints)
+            self.assertEqual(constraints[clock], float(pll.attrs[f"FREQUENCY_PIN_{output}"]) * 1e6)
+
+    def test_fast_out_domain(self):
+        generator, fragment = self.elaborate()
+        self.assertIsNone(generator.clk_fast_out)
+        self.assertNotIn("fast_out", fragment.domains)
+        self.assertNotIn("fast_out_reset", [name for _, name in fragment.subfragments])
+
+        # If requested, our fast_out domain should be generated by CLKOS3, as a shifted copy of our fast clock.
+        generator, fragment = self.elaborate(fast_out_phase=180)
+        pll = self.find_pll(fragment)
+
+        self.assertIn("fast_out", fragment.domains)
+        self.assertEqual(generator.clk_fast_out.domain, "fast_out")
+        self.assertIn("fast_out_reset", [name for _, name in fragment.subfragments])
+        self.assertIs(generator.generate_fast_out_clock(None, None), pll.named_ports["CLKOS3"][0])
+        self.assertEqual(pll.parameters["CLKOS3_DIV"],    pll.parameters["CLKOP_DIV"])
+        self.assertEqual(pll.parameters["CLKOS3_CPHASE"], 2)
+        self.assertEqual(pll.parameters["CLKOS3_FPHASE"], 0)
+
+    def test_internal_feedback(self):
+        # If all of our domains come from our PLL, it should use its internal feedback path.
+        _, fragment = self.elaborate()
+        pll = self.find_pll(fragment)
+
+        self.assertEqual(pll.parameters["FEEDBK_PATH"], "INT_OP")
+        self.assertIs(pll.named_ports["CLKFB"][0], pll.named_ports["CLKINTFB"][0])
+
+    def test_external_feedback(self):
+        # If any of our domains bypass our PLL, it should feed back from CLKOP's clock net.
+        _, fragment = self.elaborate(bypass_pll_for_input_frequency=True)
+        pll = self.find_pll(fragment)
+
+        self.assertEqual(pll.parameters["FEEDBK_PATH"], "CLKOP")
+        self.assertIs(pll.named_ports["CLKFB"][0], pll.named_ports["CLKOP"][0])
+        self.assertNotIn("CLKINTFB", pll.named_ports)
+
+    def test_no_pll(self):
+        # If all of our domains run straight from our input clock, we shouldn't need a PLL at all...
+        generator, fragment = self.elaborate(bypass_pll_for_input_frequency=True,
+            clock_frequencies={"fast": 60, "sync": 60, "usb": 60})
+        self.assertIsNone(self.find_pll(fragment))
+
+        # ... and our lock signal should be tied high.
+        lock_drivers = [statement.rhs for statement in fragment.statements
+            if isinstance(statement, Assign) and statement.lhs is generator._pll_lock]
+        self.assertEqual(len(lock_drivers), 1)
+        self.assertEqual(lock_drivers[0].value, 1)
+
+    def test_static_phase(self):
+        # Our fast_out clock's phase should be set only by our static CPHASE/FPHASE settings.
+        _, fragment = self.elaborate(fast_out_phase=180)
+        pll = self.find_pll(fragment)
+
+        self.assertEqual(pll.parameters["DPHASE_SOURCE"], "DISABLED")
+        for port in ("PHASESEL0", "PHASESEL1", "PHASEDIR", "PHASESTEP", "PHASELOADREG"):
+            self.assertEqual(pll.named_ports[port][0].value, 0)
+
+    def test_pll_site(self):
+        _, fragment = self.elaborate()
+        self.assertNotIn("BEL", self.find_pll(fragment).attrs)
+
+        _, fragment = self.elaborate(pll_site="X0/Y47/EHXPLL_LL")
+        self.assertEqual(self.find_pll(fragment).attrs["BEL"], "X0/Y47/EHXPLL_LL")
+        self.assertNotIn("LOC", self.find_pll(fragment).attrs)
+
+        # Diamond site names aren't valid nextpnr BELs...
+        with self.assertRaises(ValueError):
+            self.elaborate(pll_site="PLL_BL0")
+
+        # ... but are what Diamond expects, as a LOC constraint.
+        _, fragment = self.elaborate(StubECP5Platform(toolchain="Diamond"), pll_site="PLL_BL0")
+        self.assertEqual(self.find_pll(fragment).attrs["LOC"], "PLL_BL0")
+        self.assertNotIn("BEL", self.find_pll(fragment).attrs)
+
+    def elaborate_strobe_crossing(self, platform=None, **kwargs):
+        """ Elaborates a StrobeCrossingTop; returning it and the generator's fragment. """
+        top      = StrobeCrossingTop(**kwargs)
+        fragment = Fragment.get(top, platform or StubECP5Platform())
+        return top, self.find_subfragment(fragment, "car")
+
+    def find_driver(self, fragment, signal):
+        """ Returns the value a given fragment combinationally assigns to a signal. """
+        drivers = [statement.rhs for statement in fragment.statements
+            if isinstance(statement, Assign) and statement.lhs is signal]
+        self.assertEqual(len(drivers), 1)
+        return drivers[0]
+
+    def test_strobe_stretching(self):
+        # With our default 120MHz sync and 60MHz usb domains, our strobe should be stretched in our sync domain.
+        top, car = self.elaborate_strobe_crossing()
+        self.assertIsNot(self.find_driver(car, top.usb_strobe), top.strobe)
+        self.assertIn("delayed_strobe", [signal.name for signal in car.drivers.get("sync", ())])
+
+    def test_strobe_synchronization(self):
+        # If our usb domain bypasses our PLL, but our sync domain doesn't, the two aren't in phase;
+        # so our strobe should be carried across by a pulse synchronizer, rather than stretched.
+        top, car = self.elaborate_strobe_crossing(bypass_pll_for_input_frequency=True)
+        self.assertIsNone(top.car._sync_to_usb_cycles)
+        self.assertNotIn("delayed_strobe", [signal.name for signal in car.drivers.get("sync", ())])
+
+        synchronizers = [subfragment for subfragment, _ in car.subfragments
+            if {"sync", "usb"} <= set(subfragment.drivers)]
+        self.assertEqual(len(synchronizers), 1)
+
+    def test_strobe_ratio_uses_platform_frequencies(self):
+        # Our platform's defaults should be taken into account when creating strobe crossings, even
+        # if they differ from the generator's own defaults; and even if our strobe was requested before
+        # our generator was elaborated.
+        class SlowSyncPlatform(StubECP5Platform):
+            DEFAULT_CLOCK_FREQUENCIES_MHZ = {"fast": 120, "sync": 60, "usb": 60}
+
+        top, car = self.elaborate_strobe_crossing(SlowSyncPlatform())
+        self.assertEqual(top.car._sync_to_usb_cycles, 1)
+
+        # Our sync and usb clocks are identical; so our strobe shouldn't be stretched at all.
+        self.assertIs(self.find_driver(car, top.usb_strobe), top.strobe)
+        self.assertNotIn("delayed_strobe", [signal.name for signal in car.drivers.get("sync", ())])